@@ -2,6 +2,12 @@
 import json
 import sys
 
-data = json.loads(sys.argv[1])
-
-print(json.dumps(data))
\ No newline at end of file
+for line in sys.stdin:
+    if not line.strip():
+        continue
+    try:
+        data = json.loads(line)
+    except ValueError as error:
+        print(f'Error: {type(error).__name__}: {error}', flush=True)
+        continue
+    print(json.dumps(data), flush=True)
@@ -1,8 +1,104 @@
 const express = require('express')
 const { spawn } = require('child_process')
+const os = require('os')
 const app = express()
 const port = 3030
 
+// long-lived python processes, at most one per CPU across all solvers; each
+// worker solves one request at a time so a crash only fails its own request
+const poolSize = os.cpus().length || 4
+const solvers = ['echo', 'solver_distance', 'solver_time']
+const workers = []
+const queue = []
+
+function spawnWorker(solver) {
+    const worker = {
+        solver: solver,
+        // stderr goes straight to ours so an unread pipe never blocks a worker
+        python: spawn('python', [solver + '.py'], { stdio: ['pipe', 'pipe', 'inherit'] }),
+        res: null,
+        buffer: ''
+    }
+
+    // collect data from script, one response per line; decoding the stream
+    // keeps multi-byte characters split across chunks intact
+    worker.python.stdout.setEncoding('utf8')
+    worker.python.stdout.on('data', function (data) {
+        worker.buffer += data
+        let newline
+        while ((newline = worker.buffer.indexOf('\n')) !== -1) {
+            const line = worker.buffer.slice(0, newline)
+            worker.buffer = worker.buffer.slice(newline + 1)
+            const res = worker.res
+            worker.res = null
+            if (!res) {
+                continue
+            }
+            // the solver rejected this problem but keeps serving others
+            if (line.startsWith('Error: ')) {
+                res.status(400)
+            }
+            res.send(line)
+        }
+        dispatch()
+    });
+
+    // a dead worker is handled by the close event below
+    worker.python.stdin.on('error', () => {});
+
+    // in close event the worker is gone, drop it and fail its request
+    worker.python.on('close', (code) => {
+        console.log(`${solver} worker close all stdio with code ${code}`);
+        retire(worker)
+        if (worker.res) {
+            worker.res.status(500).send(`${solver} worker exited with code ${code}`)
+            worker.res = null
+        }
+        dispatch()
+    });
+
+    workers.push(worker)
+    return worker
+}
+
+function retire(worker) {
+    const position = workers.indexOf(worker)
+    if (position !== -1) {
+        workers.splice(position, 1)
+    }
+}
+
+function getWorker(solver) {
+    // reuse an idle worker of this solver first
+    const idle = workers.find((worker) => worker.solver === solver && !worker.res)
+    if (idle) {
+        return idle
+    }
+    if (workers.length >= poolSize) {
+        // make room by stopping an idle worker of another solver, if any
+        const spare = workers.find((worker) => !worker.res)
+        if (!spare) {
+            return null
+        }
+        retire(spare)
+        spare.python.stdin.end()
+    }
+    return spawnWorker(solver)
+}
+
+function dispatch() {
+    // hand queued requests, in order, to workers as they become free
+    while (queue.length > 0) {
+        const worker = getWorker(queue[0].solver)
+        if (!worker) {
+            return
+        }
+        const job = queue.shift()
+        worker.res = job.res
+        worker.python.stdin.write(job.data + '\n')
+    }
+}
+
 app.use(express.json())
 
 app.post('/', (req, res) => {
@@ -18,24 +114,18 @@ app.post('/', (req, res) => {
     }
     delete body.options
 
-    let data = JSON.stringify(body)
-    var largeDataSet = [];
-
-    // spawn new child process to call the python script
-    const python = spawn('python', [solver + '.py', data]);
+    // only known solvers get a worker pool
+    if (!solvers.includes(solver)) {
+        res.status(400).send('Unknown solver')
+        return
+    }
 
-    // collect data from script
-    python.stdout.on('data', function (data) {
-        largeDataSet.push(data)
-    });
+    let data = JSON.stringify(body)
 
-    // in close event we are sure that stream from child process is closed
-    python.on('close', (code) => {
-        console.log(`child process close all stdio with code ${code}`);
-        // send data to browser
-        res.send(largeDataSet.join(""))
-    });
+    // queue the problem for the next free solver process
+    queue.push({ solver: solver, data: data, res: res })
+    dispatch()
 
 })
 
-app.listen(port, () => console.log(`OrTools HTTP Wrapper listening on port ${port}!`))
\ No newline at end of file
+app.listen(port, () => console.log(`OrTools HTTP Wrapper listening on port ${port}!`))
@@ -1,71 +1,59 @@
 
+import mmap
+import os
 import sys
-import json
-import math
+import traceback
+
+import numpy as np
+import orjson
 
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 
-def print_solution(data, manager, routing, solution):
-    """Prints solution on console."""
-    print(f'Objective: {solution.ObjectiveValue()}')
-    max_route_distance = 0
-    for vehicle_id in range(data['num_vehicles']):
-        index = routing.Start(vehicle_id)
-        plan_output = 'Route for vehicle {}:\n'.format(vehicle_id)
-        route_distance = 0
-        while not routing.IsEnd(index):
-            plan_output += ' {} -> '.format(manager.IndexToNode(index))
-            previous_index = index
-            index = solution.Value(routing.NextVar(index))
-            route_distance += routing.GetArcCostForVehicle(
-                previous_index, index, vehicle_id)
-        plan_output += '{}\n'.format(manager.IndexToNode(index))
-        plan_output += 'Distance of the route: {}m\n'.format(route_distance)
-        print(plan_output)
-        max_route_distance = max(route_distance, max_route_distance)
-    print('Maximum of the route distances: {}m'.format(max_route_distance))
-
 def get_routes(solution, routing, manager):
     """Get vehicle routes from a solution and store them in an array."""
     # Get vehicle routes and store them in a two dimensional array whose
     # i,j entry is the jth location visited by vehicle i along its route.
+    start, is_end, next_var = routing.Start, routing.IsEnd, routing.NextVar
+    value, index_to_node = solution.Value, manager.IndexToNode
     routes = []
     for route_nbr in range(routing.vehicles()):
-        index = routing.Start(route_nbr)
-        route = [manager.IndexToNode(index)]
-        while not routing.IsEnd(index):
-            index = solution.Value(routing.NextVar(index))
-            route.append(manager.IndexToNode(index))
+        index = start(route_nbr)
+        route = [index_to_node(index)]
+        while not is_end(index):
+            index = value(next_var(index))
+            route.append(index_to_node(index))
         routes.append(route)
     return routes
 
 
-def main():
-    """Entry point of the program."""
-    # Instantiate the data problem.
-    data = json.loads(sys.argv[1])
+def solve_distance(data):
+    """Solve a distance routing problem and return its routes, or None."""
+    distance_matrix = np.ascontiguousarray(data['distance_matrix'], dtype=np.int64)
+    if data.get('symmetric'):
+        # Make the matrix exactly symmetric, keeping the longer of both directions.
+        distance_matrix = np.maximum(distance_matrix, distance_matrix.T)
 
     # Create the routing index manager.
-    manager = pywrapcp.RoutingIndexManager(len(data['distance_matrix']),
+    manager = pywrapcp.RoutingIndexManager(len(distance_matrix),
                                            data['num_vehicles'],
                                            data['starts'],
                                            data['ends'])
+    n2i = manager.NodeToIndex
 
     # Create Routing Model.
-    routing = pywrapcp.RoutingModel(manager)
+    model_parameters = pywrapcp.DefaultRoutingModelParameters()
+    model_parameters.reduce_vehicle_cost_model = True
+    routing = pywrapcp.RoutingModel(manager, model_parameters)
 
-    # Create and register a transit callback.
-    def distance_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['distance_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # Register the distance matrix as a transit evaluator.
+    transit_callback_index = routing.RegisterTransitMatrix(distance_matrix.tolist())
 
     # Define cost of each arc.
+    # All vehicles share this single evaluator, which lets the model reduce
+    # vehicle costs to one class; keep it that way rather than registering
+    # per-vehicle evaluators.
+    assert routing.vehicles() == data['num_vehicles']
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     # Priority
@@ -73,7 +61,7 @@ def main():
         # Create a "counter" dimension
         routing.AddConstantDimension(
           1, # add one at each node
-          999999999, # max
+          len(distance_matrix), # max
           True, # start to 0
           'counter' # name of this dimension
         )
@@ -81,30 +69,81 @@ def main():
 
         # Priority.
         for node in data['high_priority_nodes']:
-            index = manager.NodeToIndex(node)
+            index = n2i(node)
             counter.SetCumulVarSoftUpperBound(index, len(data['high_priority_nodes']), 10 * 1000)
 
     # Locks
     if 'locks' in data:
-        result = list(map(lambda x: manager.NodeToIndex(x), data['locks']))
+        result = [n2i(node) for node in data['locks']]
         routing.ApplyLocks(result)
 
-    # Setting first solution heuristic.
+    # Setting first solution heuristic and local search metaheuristic.
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.SAVINGS)
+    # Guided local search only stops at its time limit, so it is used only
+    # when the caller sets one (in seconds, fractions allowed).
+    if 'time_limit_s' in data:
+        search_parameters.local_search_metaheuristic = (routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+        search_parameters.time_limit.FromMilliseconds(int(float(data['time_limit_s']) * 1000))
 
     # Solve the problem.
     solution = routing.SolveWithParameters(search_parameters)
 
-    # Print solution on console.
     if solution:
-        routes = get_routes(solution, routing, manager)
-        #print_solution(data, manager, routing, solution)
-        print(json.dumps(routes))
+        return get_routes(solution, routing, manager)
+    return None
+
+
+def write_routes(routes):
+    """Write routes, or a notice that none were found, as one stdout line."""
+    if routes is not None:
+        sys.stdout.buffer.write(orjson.dumps(routes) + b'\n')
     else:
-        print('No solution found !')
+        sys.stdout.buffer.write(b'No solution found !\n')
+    sys.stdout.buffer.flush()
+
+def write_error(error):
+    """Write a failed request as one stdout line and its traceback to stderr."""
+    traceback.print_exc()
+    message = f'Error: {type(error).__name__}: {error}'.replace('\n', ' ')
+    sys.stdout.buffer.write(message.encode() + b'\n')
+    sys.stdout.buffer.flush()
+
+def load_problem(path):
+    """Load a problem from a JSON file through a read-only memory map."""
+    with open(path, 'rb') as f:
+        # mmap cannot map a zero-length file
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f'empty problem file: {path}')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view)
 
-if __name__ == '__main__':
-    main()
 
+def main():
+    """Entry point of the program."""
+    # Solve a single problem given as a JSON file path, for large instances.
+    if len(sys.argv) > 1:
+        try:
+            routes = solve_distance(load_problem(sys.argv[1]))
+        except Exception as error:
+            write_error(error)
+            sys.exit(1)
+        write_routes(routes)
+        return
+
+    # Otherwise solve one problem per line of stdin and answer each with one
+    # line, so a single process can serve many requests.
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            routes = solve_distance(orjson.loads(line))
+        except Exception as error:
+            # Answer a bad problem without taking down the worker.
+            write_error(error)
+            continue
+        write_routes(routes)
 
+if __name__ == '__main__':
+    main()
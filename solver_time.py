@@ -1,122 +1,90 @@
 
+import mmap
+import os
 import sys
-import json
-import math
+import traceback
+
+import numpy as np
+import orjson
 
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 
-def print_solution(data, manager, routing, solution):
-    """Prints solution on console."""
-    print(f'Objective: {solution.ObjectiveValue()}')
-    time_dimension = routing.GetDimensionOrDie('Time')
-    total_time = 0
-    for vehicle_id in range(data['num_vehicles']):
-        index = routing.Start(vehicle_id)
-        plan_output = 'Route for vehicle {}:\n'.format(vehicle_id)
-        while not routing.IsEnd(index):
-            time_var = time_dimension.CumulVar(index)
-            plan_output += '{0} Time({1},{2}) -> '.format(
-                manager.IndexToNode(index), solution.Min(time_var),
-                solution.Max(time_var))
-            index = solution.Value(routing.NextVar(index))
-        time_var = time_dimension.CumulVar(index)
-        plan_output += '{0} Time({1},{2})\n'.format(manager.IndexToNode(index),
-                                                    solution.Min(time_var),
-                                                    solution.Max(time_var))
-        plan_output += 'Time of the route: {}min\n'.format(
-            solution.Min(time_var))
-        print(plan_output)
-        total_time += solution.Min(time_var)
-    print('Total time of all routes: {}min'.format(total_time))
-
 def get_routes(solution, routing, manager):
     """Get vehicle routes from a solution and store them in an array."""
     # Get vehicle routes and store them in a two dimensional array whose
     # i,j entry is the jth location visited by vehicle i along its route.
+    start, is_end, next_var = routing.Start, routing.IsEnd, routing.NextVar
+    value, index_to_node = solution.Value, manager.IndexToNode
     routes = []
     for route_nbr in range(routing.vehicles()):
-        index = routing.Start(route_nbr)
-        route = [manager.IndexToNode(index)]
-        while not routing.IsEnd(index):
-            index = solution.Value(routing.NextVar(index))
-            route.append(manager.IndexToNode(index))
+        index = start(route_nbr)
+        route = [index_to_node(index)]
+        while not is_end(index):
+            index = value(next_var(index))
+            route.append(index_to_node(index))
         routes.append(route)
     return routes
 
-def get_cumul_data(solution, routing, dimension):
-    """Get cumulative data from a dimension and store it in an array."""
-    # Returns an array cumul_data whose i,j entry contains the minimum and
-    # maximum of CumulVar for the dimension at the jth node on route :
-    # - cumul_data[i][j][0] is the minimum.
-    # - cumul_data[i][j][1] is the maximum.
-
-    cumul_data = []
-    for route_nbr in range(routing.vehicles()):
-        route_data = []
-        index = routing.Start(route_nbr)
-        dim_var = dimension.CumulVar(index)
-        route_data.append([solution.Min(dim_var), solution.Max(dim_var)])
-        while not routing.IsEnd(index):
-            index = solution.Value(routing.NextVar(index))
-            dim_var = dimension.CumulVar(index)
-            route_data.append([solution.Min(dim_var), solution.Max(dim_var)])
-
-        cumul_data.append(route_data)
-
-    return cumul_data
 
-
-def main():
-    """Entry point of the program."""
-    # Instantiate the data problem.
-    data = json.loads(sys.argv[1])
+def solve_time(data):
+    """Solve a time windowed routing problem and return its routes, or None."""
+    starts_set = frozenset(data['starts'])
+    ends_set = frozenset(data['ends'])
 
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(len(data['time_matrix']),
                                            data['num_vehicles'],
                                            data['starts'],
                                            data['ends'])
+    n2i = manager.NodeToIndex
 
     # Create Routing Model.
-    routing = pywrapcp.RoutingModel(manager)
-
-    # Create and register a transit callback.
-    def time_callback(from_index, to_index):
-        """Returns the travel time between the two nodes."""
-        # Convert from routing variable Index to time matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        service_time = 0 if from_node in data['starts'] else data['service_times'][from_node]
-        time = data['time_matrix'][from_node][to_node] + service_time
-        return time
-
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
+    model_parameters = pywrapcp.DefaultRoutingModelParameters()
+    model_parameters.reduce_vehicle_cost_model = True
+    routing = pywrapcp.RoutingModel(manager, model_parameters)
+
+    # Register the travel time matrix, with the service time of the origin
+    # node folded in (no service time at start nodes), as a transit evaluator.
+    time_matrix = np.ascontiguousarray(data['time_matrix'], dtype=np.int64)
+    service_times = np.asarray(data['service_times'], dtype=np.int64)
+    service_times[list(starts_set)] = 0
+    transit_matrix = (time_matrix + service_times[:, None]).tolist()
+    transit_callback_index = routing.RegisterTransitMatrix(transit_matrix)
 
     # Define cost of each arc.
+    # All vehicles share this single evaluator, which lets the model reduce
+    # vehicle costs to one class; keep it that way rather than registering
+    # per-vehicle evaluators.
+    assert routing.vehicles() == data['num_vehicles']
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     # Add Time Windows constraint.
+    # When every node has a time window, bound the dimension by the latest
+    # window end plus the longest possible last leg; otherwise keep the
+    # 30 day horizon, as unwindowed nodes give no tighter bound.
+    horizon = 2592000
+    if data['time_windows'] and len(data['time_windows']) >= len(time_matrix):
+        horizon = (max(time_window[1] for time_window in data['time_windows']) +
+                   int(time_matrix.max(initial=0)) + int(service_times.max(initial=0)))
     time = 'Time'
     routing.AddDimension(
         transit_callback_index,
-        2592000,  # allow waiting time
-        2592000,  # maximum time per vehicle
+        horizon,  # allow waiting time
+        horizon,  # maximum time per vehicle
         False,  # Don't force start cumul to zero.
         time)
     time_dimension = routing.GetDimensionOrDie(time)
 
 
     # Add time window constraints for each location except depot.
+    excluded = starts_set | ends_set
+    cumul_var = time_dimension.CumulVar
     for location_idx, time_window in enumerate(data['time_windows']):
-        if location_idx in data['starts']:
+        if location_idx in excluded:
             continue
 
-        if location_idx in data['ends']:
-            continue
-
-        index = manager.NodeToIndex(location_idx)
-        time_dimension.CumulVar(index).SetRange(time_window[0], time_window[1])
+        cumul_var(n2i(location_idx)).SetRange(time_window[0], time_window[1])
 
     # Add time window constraints for each vehicle start node.
  #   depot_idx = data['starts'][0]
@@ -134,7 +102,7 @@ def main():
         # Create a "counter" dimension
         routing.AddConstantDimension(
           1, # add one at each node
-          999999999, # max
+          len(time_matrix), # max
           True, # start to 0
           'counter' # name of this dimension
         )
@@ -142,38 +110,91 @@ def main():
 
         # Priority.
         for node in data['high_priority_nodes']:
-            index = manager.NodeToIndex(node)
+            index = n2i(node)
             counter.SetCumulVarSoftUpperBound(index, len(data['high_priority_nodes']), 60 * 60)
 
 
     # Allow to drop nodes.
     penalty = 100000
-    for node in range(0, len(data['time_matrix'])):
-        index = manager.NodeToIndex(node)
-        if index != -1:
-            routing.AddDisjunction([index], penalty)
+    # Nodes without an index of their own (NodeToIndex returns -1) are skipped.
+    indices = [index for index in map(n2i, range(len(data['time_matrix']))) if index >= 0]
+    add_disjunction = routing.AddDisjunction
+    for index in indices:
+        add_disjunction([index], penalty)
 
 
     # Locks
     if 'locks' in data:
-        result = list(map(lambda x: manager.NodeToIndex(x), data['locks']))
+        result = [n2i(node) for node in data['locks']]
         routing.ApplyLocks(result)
 
-    # Setting first solution heuristic.
+    # Setting first solution heuristic and local search metaheuristic.
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION)
+    # Guided local search only stops at its time limit, so it is used only
+    # when the caller sets one (in seconds, fractions allowed).
+    if 'time_limit_s' in data:
+        search_parameters.local_search_metaheuristic = (routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+        search_parameters.time_limit.FromMilliseconds(int(float(data['time_limit_s']) * 1000))
 
     # Solve the problem.
     solution = routing.SolveWithParameters(search_parameters)
 
-    # Print solution on console.
     if solution:
-      #  print_solution(data, manager, routing, solution)
-        routes = get_routes(solution, routing, manager)
-     #   windows = get_cumul_data(solution, routing, time_dimension)
-        print(json.dumps(routes))
+        return get_routes(solution, routing, manager)
+    return None
+
+
+def write_routes(routes):
+    """Write routes, or a notice that none were found, as one stdout line."""
+    if routes is not None:
+        sys.stdout.buffer.write(orjson.dumps(routes) + b'\n')
     else:
-        print('No solution found !')
+        sys.stdout.buffer.write(b'No solution found !\n')
+    sys.stdout.buffer.flush()
+
+def write_error(error):
+    """Write a failed request as one stdout line and its traceback to stderr."""
+    traceback.print_exc()
+    message = f'Error: {type(error).__name__}: {error}'.replace('\n', ' ')
+    sys.stdout.buffer.write(message.encode() + b'\n')
+    sys.stdout.buffer.flush()
+
+def load_problem(path):
+    """Load a problem from a JSON file through a read-only memory map."""
+    with open(path, 'rb') as f:
+        # mmap cannot map a zero-length file
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f'empty problem file: {path}')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view)
+
+
+def main():
+    """Entry point of the program."""
+    # Solve a single problem given as a JSON file path, for large instances.
+    if len(sys.argv) > 1:
+        try:
+            routes = solve_time(load_problem(sys.argv[1]))
+        except Exception as error:
+            write_error(error)
+            sys.exit(1)
+        write_routes(routes)
+        return
+
+    # Otherwise solve one problem per line of stdin and answer each with one
+    # line, so a single process can serve many requests.
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            routes = solve_time(orjson.loads(line))
+        except Exception as error:
+            # Answer a bad problem without taking down the worker.
+            write_error(error)
+            continue
+        write_routes(routes)
 
 if __name__ == '__main__':
     main()